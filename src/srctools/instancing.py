@@ -1,7 +1,9 @@
+# cython: language_level=3, binding=True
 """Implements support for collapsing instances."""
 from enum import Enum
 from pathlib import Path
-from typing import Union, Tuple, Dict, Set, Iterable, Container, List
+from typing import Optional, Union, Tuple, Dict, Set, Iterable, Callable, Container, List
+from weakref import WeakKeyDictionary
 from srctools import Matrix, Vec, Angle, conv_float, Property
 from srctools.vmf import Entity, EntityFixup, FixupValue, VMF, Output, VisGroup
 from srctools.fgd import ValueTypes, FGD, EntityDef, EntityTypes
@@ -13,7 +15,29 @@ LOGGER = srctools.logger.get_logger(__name__)
 # Hidden variable to track the number of recursions.
 RECUR_COUNT_ATTR = '_inst_recur_count'
 # Prevent displaying errors for missing keyvalues multiple times.
-_UNKNOWN_KV: Set[Tuple[str, str]] = set()
+# Keyed by classname, so repeat probes hash only the key name.
+_UNKNOWN_KV: Dict[str, Set[str]] = {}
+# Keyvalue names are drawn from a tiny vocabulary but are folded for every
+# entity of every collapse, so cache the results across all instances.
+_KEY_FOLD_CACHE: Dict[str, str] = {}
+# Keyvalues always skipped when transforming entities.
+_SKIPPED_KEYS = frozenset({'classname', 'hammerid', 'spawnflags', 'nodeid'})
+# Shared copy of the engine database. Collapsing only reads from the FGD,
+# so every call can use the same copy instead of re-parsing per call.
+_ENGINE_FGD: Optional[FGD] = None
+# The _CBaseEntity_ fallback located in each database.
+_BASE_ENTITY_CACHE: 'WeakKeyDictionary[FGD, EntityDef]' = WeakKeyDictionary()
+
+
+def _engine_fgd() -> FGD:
+    """Fetch the engine database, parsing it only on the first call."""
+    global _ENGINE_FGD
+    if _ENGINE_FGD is None:
+        _ENGINE_FGD = FGD.engine_dbase()
+    return _ENGINE_FGD
+
+
+_IDENTITY_ORIENT = Matrix()
 
 
 class FixupStyle(Enum):
@@ -25,6 +49,24 @@ class FixupStyle(Enum):
 
 class Instance:
     """Represents an instance with all the values required to collapse it."""
+    __slots__ = [
+        '_name',
+        '_name_prefix',
+        '_name_suffix',
+        'filename',
+        'pos',
+        'orient',
+        'fixup_type',
+        'fixup',
+        'outputs',
+        'ent_ids',
+        'face_ids',
+        'brush_ids',
+        'node_ids',
+        'visgroup_ids',
+        'recur_count',
+    ]
+
     def __init__(
         self,
         name: str,
@@ -75,18 +117,35 @@ class Instance:
         inst.recur_count = getattr(ent, RECUR_COUNT_ATTR, 0)
         return inst
 
+    @property
+    def name(self) -> str:
+        """The name of this instance."""
+        return self._name
+
+    @name.setter
+    def name(self, value: str) -> None:
+        self._name = value
+        # Cache the concatenations fixup_name() prepends/appends, they're
+        # reused for every name in the instance.
+        self._name_prefix = value + '-'
+        self._name_suffix = '-' + value
+
+    @property
+    def transform_is_identity(self) -> bool:
+        """Check if this instance collapses with no offset or rotation.
+
+        Manifests always do, so the positional maths can be skipped.
+        """
+        return self.pos == (0.0, 0.0, 0.0) and self.orient == _IDENTITY_ORIENT
+
     def fixup_name(self, name: str) -> str:
         """Apply the name fixup rules to this name."""
-        if name.startswith(('@', '!')):
-            return name
-        if self.fixup_type is FixupStyle.NONE:
+        if name.startswith(('@', '!')) or self.fixup_type is FixupStyle.NONE:
             return name
         elif self.fixup_type is FixupStyle.PREFIX:
-            return f'{self.name}-{name}'
-        elif self.fixup_type is FixupStyle.SUFFIX:
-            return f'{name}-{self.name}'
-        else:
-            raise AssertionError(f'Unknown fixup type {self.fixup_type}')
+            return self._name_prefix + name
+        else:  # Only SUFFIX remains.
+            return name + self._name_suffix
 
     def fixup_key(
         self,
@@ -100,56 +159,119 @@ class Instance:
         - classnames is a set of known entity classnames, used to avoid renaming
         those.
         """
-        # All three are absolute positions.
-        if type is ValueTypes.VEC or type is ValueTypes.VEC_ORIGIN or type is ValueTypes.VEC_LINE:
-            return str(Vec.from_str(value) @ self.orient + self.pos)
-        elif type is ValueTypes.ANGLES:
-            return str(Angle.from_str(value) @ self.orient)
-        elif type.is_ent_name:  # Target destination etc.
-            return self.fixup_name(value)
-        elif type is ValueTypes.TARG_DEST_CLASS:
-            # Target destination, but also classnames which we don't want to change.
-            if value.casefold() not in classnames:
-                return self.fixup_name(value)
-        elif type is ValueTypes.EXT_VEC_DIRECTION:
-            return str(Vec.from_str(value) @ self.orient)
-        elif type is ValueTypes.SIDE_LIST:
-            # Remap old sides to new. If not found skip.
-            sides = []
-            for side in value.split():
-                try:
-                    new_side = self.face_ids[int(side)]
-                except (KeyError, ValueError, TypeError):
-                    pass
-                else:
-                    sides.append(str(new_side))
-            sides.sort()
-            return ' '.join(sides)
-        elif type is ValueTypes.VEC_AXIS:
-            value = str(Vec.from_str(value) @ self.orient)
-        elif type is ValueTypes.TARG_NODE_SOURCE or type is ValueTypes.TARG_NODE_DEST:
-            # For each old ID always create a new ID.
-            try:
-                old_id = int(value)
-            except (ValueError, TypeError):
-                return value  # Skip.
-            try:
-                value = str(self.node_ids[old_id])
-            except KeyError:
-                self.node_ids[old_id] = new_id = vmf.node_id.get_id()
-                value = str(new_id)
-        elif type is ValueTypes.VEC_AXIS:
-            # Two positions seperated by commas.
-            first, second = value.split(',')
-            first = Vec.from_str(first) @ self.orient + self.pos
-            second = Vec.from_str(second) @ self.orient + self.pos
-            value = f'{first}, {second}'
-        # All others = no change required.
+        try:
+            handler = _FIXUP_DISPATCH[type]
+        except KeyError:
+            # All others = no change required.
+            return value
+        return handler(self, vmf, classnames, value)
+
+
+def _fixup_position(inst: Instance, vmf: VMF, classnames: Container[str], value: str) -> str:
+    """An absolute position, which is shifted to the instance location."""
+    if inst.transform_is_identity:
+        return value
+    pos = Vec.from_str(value)
+    pos.localise(inst.pos, inst.orient)
+    return str(pos)
+
+
+def _fixup_angles(inst: Instance, vmf: VMF, classnames: Container[str], value: str) -> str:
+    """An angles value, only rotated."""
+    if inst.transform_is_identity:
         return value
+    return str(Angle.from_str(value) @ inst.orient)
+
+
+def _fixup_ent_name(inst: Instance, vmf: VMF, classnames: Container[str], value: str) -> str:
+    """Target destination etc."""
+    return inst.fixup_name(value)
+
+
+def _fixup_name_or_class(inst: Instance, vmf: VMF, classnames: Container[str], value: str) -> str:
+    """Target destination, but also classnames which we don't want to change."""
+    if value.casefold() not in classnames:
+        return inst.fixup_name(value)
+    return value
+
+
+def _fixup_direction(inst: Instance, vmf: VMF, classnames: Container[str], value: str) -> str:
+    """A direction vector, rotated but not translated."""
+    if inst.transform_is_identity:
+        return value
+    direction = Vec.from_str(value)
+    direction @= inst.orient
+    return str(direction)
+
+
+def _fixup_side_list(inst: Instance, vmf: VMF, classnames: Container[str], value: str) -> str:
+    """Remap old sides to new. If not found skip."""
+    face_ids = inst.face_ids
+    sides = []
+    for side in value.split():
+        try:
+            new_side = face_ids[int(side)]
+        except (KeyError, ValueError, TypeError):
+            pass
+        else:
+            sides.append(str(new_side))
+    sides.sort()
+    return ' '.join(sides)
+
+
+def _fixup_axis(inst: Instance, vmf: VMF, classnames: Container[str], value: str) -> str:
+    """Two positions seperated by commas. If malformed skip."""
+    if inst.transform_is_identity:
+        return value
+    try:
+        first_str, second_str = value.split(',')
+    except ValueError:
+        return value
+    first = Vec.from_str(first_str)
+    first.localise(inst.pos, inst.orient)
+    second = Vec.from_str(second_str)
+    second.localise(inst.pos, inst.orient)
+    return f'{first}, {second}'
+
+
+def _fixup_node_id(inst: Instance, vmf: VMF, classnames: Container[str], value: str) -> str:
+    """For each old ID always create a new ID."""
+    try:
+        old_id = int(value)
+    except (ValueError, TypeError):
+        return value  # Skip.
+    try:
+        return str(inst.node_ids[old_id])
+    except KeyError:
+        inst.node_ids[old_id] = new_id = vmf.node_id.get_id()
+        return str(new_id)
+
+
+# Maps each type needing a transform to its handler, replacing a long
+# if/elif chain of identity comparisons per keyvalue.
+_FIXUP_DISPATCH: Dict[ValueTypes, Callable[[Instance, VMF, Container[str], str], str]] = {
+    typ: _fixup_ent_name
+    for typ in ValueTypes if typ.is_ent_name
+}
+_FIXUP_DISPATCH.update({
+    # All three are absolute positions.
+    ValueTypes.VEC: _fixup_position,
+    ValueTypes.VEC_ORIGIN: _fixup_position,
+    ValueTypes.VEC_LINE: _fixup_position,
+    ValueTypes.ANGLES: _fixup_angles,
+    ValueTypes.TARG_DEST_CLASS: _fixup_name_or_class,
+    ValueTypes.EXT_VEC_DIRECTION: _fixup_direction,
+    ValueTypes.SIDE_LIST: _fixup_side_list,
+    ValueTypes.VEC_AXIS: _fixup_axis,
+    ValueTypes.TARG_NODE_SOURCE: _fixup_node_id,
+    ValueTypes.TARG_NODE_DEST: _fixup_node_id,
+})
 
 
 class Manifest(Instance):
     """Additional options set in VMM manifests."""
+    __slots__ = ['id', 'is_toplevel']
+
     def __init__(
         self,
         name: str,
@@ -179,6 +301,8 @@ class Manifest(Instance):
 
 class Param:
     """Configuration for a specific fixup variable."""
+    __slots__ = ['name', 'type', 'default']
+
     def __init__(
         self,
         name: str,
@@ -192,6 +316,8 @@ class Param:
 
 class InstanceFile:
     """Represents an instance VMF which has been parsed."""
+    __slots__ = ['vmf', 'params', 'proxy_inputs', 'proxy_outputs', 'proxy_pos']
+
     def __init__(self, vmf: VMF) -> None:
         self.vmf = vmf
         self.params: Dict[str, Param] = {}
@@ -242,13 +368,53 @@ class InstanceFile:
                 if out.output.casefold() == 'onproxyrelay':
                     self.proxy_inputs[out.target.casefold(), out.input.casefold()] = out
                     out.output = ''
-        # Now, outputs.
+        # Now, outputs. Filter in a single pass - list.remove() would rescan
+        # the outputs for each proxy output extracted.
         for ent in self.vmf.entities:
-            for out in ent.outputs[:]:
+            kept_outputs = []
+            for out in ent.outputs:
                 if out.input.casefold() == 'proxyrelay' and out.target.casefold() in proxy_names:
-                    ent.outputs.remove(out)
                     self.proxy_outputs[ent['targetname'].casefold(), out.output.casefold()] = (ent.id, out)
                     out.input = out.target = ''
+                else:
+                    kept_outputs.append(out)
+            if len(kept_outputs) != len(ent.outputs):
+                ent.outputs[:] = kept_outputs
+
+
+# Parsed instance files, shared across collapse_all() calls. Keyed first by
+# the filesystem - the same relative path in two different maps' search
+# locations is legitimately two different files, and mtime-based cache keys
+# can collide between them. Holding the filesystems weakly means each map's
+# entries are freed along with its filesystem, keeping the cache bounded
+# for batch pipelines that build a fresh one per map. The cache key
+# recorded alongside detects files changing on disk.
+_INST_FILE_CACHE: 'WeakKeyDictionary[FileSystem, Dict[str, Tuple[int, InstanceFile]]]' = WeakKeyDictionary()
+
+
+def _parse_inst_file(fsys: FileSystem, filename: str) -> InstanceFile:
+    """Parse an instance VMF, reusing previous parses if unchanged.
+
+    Batch tools collapse the same instance files into many maps, so the
+    parse and proxy rewiring only needs doing once per filesystem.
+    """
+    cache_key = fsys[filename].cache_key()
+    try:
+        fsys_cache = _INST_FILE_CACHE[fsys]
+    except KeyError:
+        fsys_cache = _INST_FILE_CACHE[fsys] = {}
+    try:
+        old_key, file = fsys_cache[filename]
+    except KeyError:
+        pass
+    else:
+        # A key of -1 means caching isn't possible for this filesystem.
+        if cache_key != -1 and cache_key == old_key:
+            return file
+    props = fsys.read_prop(filename)
+    file = InstanceFile(VMF.parse(props, preserve_ids=True))
+    fsys_cache[filename] = (cache_key, file)
+    return file
 
 
 def get_inst_locs(map_filename: Path) -> FileSystemChain:
@@ -267,12 +433,30 @@ def get_inst_locs(map_filename: Path) -> FileSystemChain:
     return fsys
 
 
+def _build_output_index(vmf: VMF) -> Dict[str, List[Output]]:
+    """Index all instance-input outputs, by their casefolded target.
+
+    This lets collapse_one() find the outputs pointing into an instance
+    without scanning the whole map, and folds each target only once.
+    When collapsing many instances the same index can be shared -
+    collapse_one() keeps it up to date as outputs are rewritten and new
+    entities appear.
+    """
+    index: Dict[str, List[Output]] = {}
+    for ent in vmf.entities:
+        for out in ent.outputs:
+            if out.inst_in is not None:
+                index.setdefault(out.target.casefold(), []).append(out)
+    return index
+
+
 def collapse_one(
     vmf: VMF,
     inst: Instance,
     file: InstanceFile,
     fgd: FGD=None,
     visgroup: Union[bool, VisGroup]=False,
+    output_index: Dict[str, List[Output]]=None,
 ) -> None:
     """Collapse a single instance into the map.
 
@@ -283,19 +467,27 @@ def collapse_one(
     * If true, the original visgroups will be kept
     * If set to a specific visgroup, all ents and brushes will be added to it,
         with any existing visgroups in the instance added as a child.
+    If collapsing several instances, an index from _build_output_index() can
+    be passed to each call to share the scan over the map's outputs.
     """
     origin = inst.pos
     orient = inst.orient
+    # Manifests collapse in-place, so all the positional maths is a no-op.
+    identity_tf = inst.transform_is_identity
     id_to_ent: Dict[int, Entity] = {}
 
     if fgd is None:
-        fgd = FGD.engine_dbase()
+        fgd = _engine_fgd()
     # Contains all base-entity keyvalues, as a fallback.
     try:
-        base_entity = fgd['_CBaseEntity_']
+        base_entity = _BASE_ENTITY_CACHE[fgd]
     except KeyError:
-        LOGGER.warning('No CBaseEntity definition!')
-        base_entity = EntityDef(EntityTypes.BASE)
+        try:
+            base_entity = fgd['_CBaseEntity_']
+        except KeyError:
+            LOGGER.warning('No CBaseEntity definition!')
+            base_entity = EntityDef(EntityTypes.BASE)
+        _BASE_ENTITY_CACHE[fgd] = base_entity
 
     if visgroup is not False:
         for old_group in file.vmf.vis_tree:
@@ -309,71 +501,95 @@ def collapse_one(
     else:
         ungrouped_group = set()
 
+    # Invariants for the brush loop, hoisted out - these add up over
+    # thousands of brushes.
+    face_ids = inst.face_ids
+    brush_ids = inst.brush_ids
+    add_brush = vmf.add_brush
+    keep_vis = visgroup is not False
+
     for old_brush in file.vmf.brushes:
         if old_brush.hidden or not old_brush.vis_shown:
             continue
-        new_brush = old_brush.copy(vmf_file=vmf, side_mapping=inst.face_ids, keep_vis=visgroup is not False)
-        vmf.add_brush(new_brush)
-        inst.brush_ids[old_brush.id] = new_brush.id
-        new_brush.localise(origin, orient)
+        new_brush = old_brush.copy(vmf_file=vmf, side_mapping=face_ids, keep_vis=keep_vis)
+        add_brush(new_brush)
+        brush_ids[old_brush.id] = new_brush.id
+        if not identity_tf:
+            new_brush.localise(origin, orient)
         # Convert across the IDs.
-        if visgroup is not False:
+        if keep_vis:
             new_brush.visgroup_ids = {
                 inst.visgroup_ids[old]
                 for old in new_brush.visgroup_ids
             } or ungrouped_group.copy()
 
     # Before adding the ents, apply instance inputs.
+    if output_index is None:
+        output_index = _build_output_index(vmf)
     folded_inst_name = inst.name.casefold()
-    for ent in vmf.entities:
-        for out in ent.outputs:
-            if out.target.casefold() != folded_inst_name or out.inst_in is None:
-                continue
-            try:
-                proxy_out = file.proxy_inputs[out.inst_in, out.input]
-            except KeyError:
-                # Not an error, could be another instance with our name.
-                continue
-            # Output.combine(), but in-place.
-            out.target = proxy_out.target
-            out.input = proxy_out.input
-            out.inst_in = None
-            if proxy_out.params:
-                out.params = proxy_out.params
-            out.times = min(out.times, proxy_out.times)
-            out.delay += proxy_out.delay
-            if not proxy_out.comma_sep:
-                out.comma_sep = False
+    remaining_outs: List[Output] = []
+    # The default must be a list - when compiled, the annotated dict type
+    # is enforced and a tuple would raise.
+    for out in output_index.pop(folded_inst_name, []):
+        try:
+            proxy_out = file.proxy_inputs[out.inst_in, out.input]
+        except KeyError:
+            # Not an error, could be another instance with our name.
+            remaining_outs.append(out)
+            continue
+        # Output.combine(), but in-place.
+        out.target = proxy_out.target
+        out.input = proxy_out.input
+        out.inst_in = None
+        if proxy_out.params:
+            out.params = proxy_out.params
+        out.times = min(out.times, proxy_out.times)
+        out.delay += proxy_out.delay
+        if not proxy_out.comma_sep:
+            out.comma_sep = False
+    if remaining_outs:
+        output_index[folded_inst_name] = remaining_outs
 
     # Only modify keyvalues after all ents have been copied over, so brush
     # IDs are all present.
     new_ents: List[Entity] = []
 
+    # Hoisted out of the per-keyvalue loop. The regex inside is compiled
+    # once per fixup, and values without a $ skip the call entirely.
+    substitute = inst.fixup.substitute
+
+    # Composed angles for each (angles, pitch, yaw) combination seen.
+    # Many entities share the same rotation, and orient is fixed here, so
+    # the parse + matrix multiply only needs doing once per combination.
+    angle_cache: Dict[Tuple[str, Optional[str], Optional[str]], Angle] = {}
+
+    add_ent = vmf.add_ent
     for old_ent in file.vmf.entities:
-        if visgroup is False and (old_ent.hidden or not old_ent.vis_shown):
+        if not keep_vis and (old_ent.hidden or not old_ent.vis_shown):
             continue
         new_ent = old_ent.copy(
             vmf_file=vmf,
-            side_mapping=inst.face_ids,
-            keep_vis=visgroup is not False
+            side_mapping=face_ids,
+            keep_vis=keep_vis,
         )
-        vmf.add_ent(new_ent)
+        add_ent(new_ent)
         new_ents.append(new_ent)
         inst.ent_ids[old_ent.id] = new_ent.id
         id_to_ent[old_ent.id] = new_ent
 
-        if visgroup is not False:
+        if keep_vis:
             new_ent.visgroup_ids = {
                 inst.visgroup_ids[old]
                 for old in old_ent.visgroup_ids
             } or ungrouped_group.copy()
 
         for old_brush, new_brush in zip(old_ent.solids, new_ent.solids):
-            inst.brush_ids[old_brush.id] = new_brush.id
-            new_brush.localise(origin, orient)
+            brush_ids[old_brush.id] = new_brush.id
+            if not identity_tf:
+                new_brush.localise(origin, orient)
 
             # Convert across the IDs.
-            if visgroup is not False:
+            if keep_vis:
                 new_brush.visgroup_ids = {
                     inst.visgroup_ids[old]
                     for old in old_brush.visgroup_ids
@@ -391,21 +607,39 @@ def collapse_one(
         if classname.casefold() == 'func_instance':
             setattr(new_ent, RECUR_COUNT_ATTR, inst.recur_count + 1)
 
+        # Keys already warned about for this classname, hashed once here.
+        unknown_keys = _UNKNOWN_KV.setdefault(classname, set())
+
         # Now keyvalues.
         # First extract a rotated angles value, handling the special "pitch" and "yaw" keys.
-        angles = Angle.from_str(new_ent['angles'])
-        if 'pitch' in new_ent:
-            angles.pitch = conv_float(new_ent['pitch'])
-        if 'yaw' in new_ent:
-            angles.yaw = conv_float(new_ent['yaw'])
-        angles @= orient
+        ang_key = (new_ent['angles'], new_ent['pitch', None], new_ent['yaw', None])
+        try:
+            angles = angle_cache[ang_key]
+        except KeyError:
+            angles = Angle.from_str(ang_key[0])
+            if ang_key[1] is not None:
+                angles.pitch = conv_float(ang_key[1])
+            if ang_key[2] is not None:
+                angles.yaw = conv_float(ang_key[2])
+            if not identity_tf:
+                angles @= orient
+            angle_cache[ang_key] = angles
 
         for key, value in new_ent.keys.items():
-            folded = key.casefold()
-            value = inst.fixup.substitute(value, '')
+            try:
+                folded = _KEY_FOLD_CACHE[key]
+            except KeyError:
+                folded = _KEY_FOLD_CACHE[key] = key.casefold()
+            if '$' in value:
+                value = substitute(value, '')
             # Hardcode these critical keyvalues to always be these types.
             if folded == 'origin':
-                new_ent['origin'] = str(Vec.from_str(value) @ orient + origin)
+                if identity_tf:
+                    new_ent['origin'] = value
+                else:
+                    pos = Vec.from_str(value)
+                    pos.localise(origin, orient)
+                    new_ent['origin'] = str(pos)
                 continue
             elif folded == 'angles':
                 new_ent['angles'] = str(angles)
@@ -416,7 +650,7 @@ def collapse_one(
             elif folded == 'yaw':
                 new_ent['yaw'] = str(angles.yaw)
                 continue
-            elif folded in ('classname', 'hammerid', 'spawnflags', 'nodeid'):
+            elif folded in _SKIPPED_KEYS:
                 continue
 
             try:
@@ -425,20 +659,20 @@ def collapse_one(
                 if folded.startswith('$') and classname == 'func_instance':
                     # Dummy fixup names Hammer provides for convenience, ignore.
                     continue
-                if (classname, key) not in _UNKNOWN_KV:
+                if key not in unknown_keys:
                     LOGGER.warning('Unknown keyvalue {}.{}', classname, key)
-                    _UNKNOWN_KV.add((classname, key))
+                    unknown_keys.add(key)
                 continue
             # This has specific interactions with angles, it needs to be the pitch KV.
             if kv.type is ValueTypes.ANGLE_NEG_PITCH:
-                if (classname, key) not in _UNKNOWN_KV:
+                if key not in unknown_keys:
                     LOGGER.warning('angle_negative_pitch should only be applied to pitch, not {}.{}', classname, key)
-                    _UNKNOWN_KV.add((classname, key))
+                    unknown_keys.add(key)
                 continue
             elif kv.type is ValueTypes.INST_VAR_REP:
-                if (classname, key) not in _UNKNOWN_KV:
+                if key not in unknown_keys:
                     LOGGER.warning('instance_variable should only be applied to replaceXX, not {}.{}', classname, key)
-                    _UNKNOWN_KV.add((classname, key))
+                    unknown_keys.add(key)
                 continue
 
             new_ent.keys[key] = inst.fixup_key(vmf, fgd, kv.type, value)
@@ -451,7 +685,14 @@ def collapse_one(
 
         # Outputs
         for out in new_ent.outputs:
-            out.target = inst.fixup_name(inst.fixup.substitute(out.target, ''))
+            target = out.target
+            if '$' in target:
+                target = substitute(target, '')
+            out.target = target = inst.fixup_name(target)
+            # Instance inputs on copied ents need indexing too, so
+            # recursive instances find them.
+            if out.inst_in is not None:
+                output_index.setdefault(target.casefold(), []).append(out)
 
     for out in inst.outputs:
         # Non-instance output, ignore - on regular ents it'd never fire.
@@ -462,7 +703,10 @@ def collapse_one(
         except KeyError:
             LOGGER.info('No output {},{} in {}', out.inst_out, out.output, inst.filename)
             continue
-        id_to_ent[ent_id].add_out(Output.combine(prox_out, out))
+        combined = Output.combine(prox_out, out)
+        id_to_ent[ent_id].add_out(combined)
+        if combined.inst_in is not None:
+            output_index.setdefault(combined.target.casefold(), []).append(combined)
 
 
 def collapse_all(
@@ -478,15 +722,17 @@ def collapse_all(
     in another - if it's exceeded they're left in the map.
     """
     if fgd is None:
-        fgd = FGD.engine_dbase()
+        fgd = _engine_fgd()
 
     auto_inst_count = 0
 
-    cache: Dict[str, InstanceFile] = {}
     for _ in range(recur_limit):
         instances = list(vmf.by_class['func_instance'])
         if not instances:
             break
+        # One scan over the map's outputs per recursion level, shared by
+        # every instance collapsed in it.
+        output_index = _build_output_index(vmf)
         for inst_ent in instances:
             inst = Instance.from_entity(inst_ent)
             inst_ent.remove()
@@ -494,12 +740,8 @@ def collapse_all(
             if not inst.name:
                 auto_inst_count += 1
                 inst.name = f'InstanceAuto{auto_inst_count}'
-            try:
-                file = cache[inst.filename]
-            except KeyError:
-                props = fsys.read_prop(inst.filename)
-                # except FileNotFoundError - fail.
-                file = cache[inst.filename] = InstanceFile(VMF.parse(props, preserve_ids=True))
-            collapse_one(vmf, inst, file, fgd)
+            # except FileNotFoundError - fail.
+            file = _parse_inst_file(fsys, inst.filename)
+            collapse_one(vmf, inst, file, fgd, output_index=output_index)
     else:  # Exhausted the range
         raise RecursionError('Loop in instances!')
@@ -0,0 +1,96 @@
+"""Tests for instance collapsing."""
+import importlib.util
+from pathlib import Path
+
+import pytest
+import srctools
+from srctools import Vec, Angle, Matrix
+from srctools.fgd import ValueTypes
+from srctools import instancing
+from srctools.vmf import VMF, Output
+
+
+def _load_py_instancing():
+    """Load the pure-Python module, even when the compiled one shadows it."""
+    path = Path(srctools.__file__).with_name('instancing.py')
+    spec = importlib.util.spec_from_file_location('srctools._py_instancing', path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+if instancing.__file__.endswith('.py'):
+    parms = [instancing]
+    names = ['Python']
+else:
+    parms = [_load_py_instancing(), instancing]
+    names = ['Python', 'Cython']
+
+
+@pytest.fixture(params=parms, ids=names)
+def inst_mod(request):
+    """Run tests against both the Python and compiled versions."""
+    return request.param
+
+
+def test_fixup_key_axis(inst_mod) -> None:
+    """VEC_AXIS holds two positions, both of which are transformed."""
+    vmf = VMF()
+    inst = inst_mod.Instance(
+        'inst', 'some_file.vmf',
+        Vec(16, 0, 0),
+        Matrix.from_angle(Angle(0, 90, 0)),
+        inst_mod.FixupStyle.PREFIX,
+    )
+    assert inst.fixup_key(
+        vmf, set(), ValueTypes.VEC_AXIS, '0 0 0, 1 0 0',
+    ) == '16 0 0, 16 1 0'
+
+    # Values without exactly one comma can't be parsed, pass them through.
+    assert inst.fixup_key(
+        vmf, set(), ValueTypes.VEC_AXIS, '16 0 0',
+    ) == '16 0 0'
+    assert inst.fixup_key(
+        vmf, set(), ValueTypes.VEC_AXIS, '1 0 0, 2 0 0, 3 0 0',
+    ) == '1 0 0, 2 0 0, 3 0 0'
+
+    # With no offset or rotation the value is left untouched.
+    identity = inst_mod.Instance(
+        'inst', 'some_file.vmf',
+        Vec(), Matrix(),
+        inst_mod.FixupStyle.PREFIX,
+    )
+    assert identity.fixup_key(
+        vmf, set(), ValueTypes.VEC_AXIS, '0 0 0, 1 0 0',
+    ) == '0 0 0, 1 0 0'
+
+
+def test_collapse_proxy_inputs(inst_mod) -> None:
+    """Check instance inputs are rewritten onto the proxied entity."""
+    file_vmf = VMF()
+    file_vmf.create_ent('func_door', targetname='door')
+    proxy = file_vmf.create_ent(
+        'func_instance_io_proxy',
+        targetname='proxy', origin='0 0 0',
+    )
+    proxy.add_out(Output('OnProxyRelay', 'door', 'open'))
+    file = inst_mod.InstanceFile(file_vmf)
+    assert ('door', 'open') in file.proxy_inputs
+
+    vmf = VMF()
+    button = vmf.create_ent('func_button', targetname='btn')
+    button.add_out(Output('OnPressed', 'inst1', 'open', inst_in='door'))
+    # This output merely shares the instance's name, it must survive.
+    button.add_out(Output('OnPressed', 'inst1', 'other', inst_in='missing'))
+    inst = inst_mod.Instance(
+        'inst1', 'some_file.vmf',
+        Vec(), Matrix(),
+        inst_mod.FixupStyle.PREFIX,
+    )
+    inst_mod.collapse_one(vmf, inst, file)
+
+    rewritten, other = button.outputs
+    assert rewritten.target == 'door'
+    assert rewritten.input == 'open'
+    assert rewritten.inst_in is None
+    assert other.inst_in == 'missing'